@@ -1,16 +1,19 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, Request, UploadFile, File
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, Response
 from pydantic import BaseModel, Field
-from typing import List, Dict
+from typing import Annotated, List, Dict
 import cv2
 import numpy as np
 from datetime import datetime
-import io
-from PIL import Image
 import sqlite3
-import json
+import threading
+import time
+import orjson
+from bisect import bisect_right
 
-app = FastAPI(title="NeuroMotion API", version="1.0.0")
+app = FastAPI(title="NeuroMotion API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # CORS Configuration
 app.add_middleware(
@@ -24,7 +27,7 @@ app.add_middleware(
 # ==================== Pydantic Models ====================
 
 class SurveyRequest(BaseModel):
-    answers: Dict[str, int] = Field(..., description="Question ID to answer mapping")
+    answers: Dict[str, Annotated[int, Field(ge=0, le=4)]] = Field(..., description="Question ID to answer (0-4) mapping")
 
 class TapRequest(BaseModel):
     intervals: List[float] = Field(..., description="Time intervals between taps in milliseconds")
@@ -51,9 +54,19 @@ class FinalDiagnostic(BaseModel):
 
 # ==================== Database Setup ====================
 
+# Single shared connection opened by init_db(); every query goes through
+# db_lock since the connection is not safe to use from several threads at once.
+db_lock = threading.Lock()
+
 def init_db():
-    conn = sqlite3.connect('test_sessions.db')
+    conn = sqlite3.connect('test_sessions.db', check_same_thread=False, isolation_level=None)
+    conn.row_factory = sqlite3.Row
     cursor = conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-20000')
+    cursor.execute('PRAGMA mmap_size=268435456')
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS sessions (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -65,42 +78,111 @@ def init_db():
             timestamp TEXT
         )
     ''')
-    conn.commit()
-    conn.close()
+    # Lets the "most recent sessions" queries read in index order instead of sorting
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_sessions_ts ON sessions(timestamp DESC)')
+    app.state.db = conn
 
 init_db()
 
+INSERT_SESSION_SQL = '''
+    INSERT INTO sessions (overall_risk, risk_level, survey_score, tap_score, spiral_score, timestamp)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+def insert_session(overall_risk: float, risk_level: str, survey_score: float,
+                   tap_score: float, spiral_score: float, timestamp: str) -> int:
+    """Persist an aggregated session and return its id"""
+    with db_lock:
+        return app.state.db.execute(
+            INSERT_SESSION_SQL,
+            (overall_risk, risk_level, survey_score, tap_score, spiral_score, timestamp)
+        ).lastrowid
+
+def insert_sessions(rows: List[tuple]) -> List[int]:
+    """Persist several aggregated sessions in one transaction and return their ids"""
+    with db_lock:
+        conn = app.state.db
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.executemany(INSERT_SESSION_SQL, rows)
+            last_id = conn.execute('SELECT last_insert_rowid()').fetchone()[0]
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    # AUTOINCREMENT ids are consecutive within the write transaction
+    return list(range(last_id - len(rows) + 1, last_id + 1))
+
+def fetch_recent_sessions() -> List[Dict]:
+    """Load the 50 most recent sessions"""
+    with db_lock:
+        rows = app.state.db.execute('SELECT * FROM sessions ORDER BY timestamp DESC LIMIT 50').fetchall()
+    return [dict(row) for row in rows]
+
+# ==================== Response Cache ====================
+
+# Serialized /api/v1/sessions responses are reused for a short while; any
+# write clears them. Only touched from the event loop thread.
+SESSIONS_CACHE_TTL = 2.0
+sessions_cache: Dict = {}
+sessions_cache_generation = 0
+
+def invalidate_sessions_cache():
+    """Drop cached session listings after a write"""
+    global sessions_cache_generation
+    sessions_cache_generation += 1
+    sessions_cache.clear()
+
+def get_cached_sessions(key):
+    """Return the cached response body for key, or None if missing or stale"""
+    entry = sessions_cache.get(key)
+    if entry is not None and time.monotonic() < entry[0]:
+        return entry[1]
+    return None
+
+def store_cached_sessions(key, body: bytes, generation: int):
+    """Cache body unless a write happened after generation was read"""
+    if generation != sessions_cache_generation:
+        return
+    now = time.monotonic()
+    for stale in [k for k, (expires, _) in sessions_cache.items() if expires <= now]:
+        del sessions_cache[stale]
+    sessions_cache[key] = (now + SESSIONS_CACHE_TTL, body)
+
 # ==================== Analysis Functions ====================
 
+# Survey question weights by clinical significance; unknown questions get 0.10
+SURVEY_WEIGHTS = {
+    "tremor": 0.25,
+    "rigidity": 0.20,
+    "bradykinesia": 0.25,
+    "balance": 0.15,
+    "walking": 0.15
+}
+
 def analyze_survey(answers: Dict[str, int]) -> tuple[float, Dict]:
     """
     Analyze survey responses based on UPDRS-like symptoms.
     Questions weighted by clinical significance.
     """
-    weights = {
-        "tremor": 0.25,
-        "rigidity": 0.20,
-        "bradykinesia": 0.25,
-        "balance": 0.15,
-        "walking": 0.15
-    }
+    count = len(answers)
+    raw = np.fromiter(answers.values(), dtype=np.float64, count=count)
+    weights = np.fromiter((SURVEY_WEIGHTS.get(q, 0.10) for q in answers), dtype=np.float64, count=count)
     
-    total_weighted = 0
-    details = {}
+    # Normalize answers (0-4 scale to 0-100)
+    normalized = raw * 25.0
     
-    for question, answer in answers.items():
-        weight = weights.get(question, 0.10)
-        # Normalize answer (0-4 scale to 0-100)
-        normalized = (answer / 4.0) * 100
-        total_weighted += normalized * weight
-        details[question] = {
+    details = {
+        question: {
             "raw_answer": answer,
-            "normalized": round(normalized, 2),
-            "weight": weight
+            "normalized": round(float(norm), 2),
+            "weight": float(weight)
         }
+        for question, answer, norm, weight in zip(answers, answers.values(), normalized, weights)
+    }
     
     # Invert score: higher symptoms = higher risk
-    final_score = round(total_weighted, 2)
+    final_score = round(float(normalized @ weights), 2)
     details["interpretation"] = get_score_interpretation(final_score)
     
     return final_score, details
@@ -113,11 +195,12 @@ def analyze_taps(intervals: List[float]) -> tuple[float, Dict]:
     if len(intervals) < 3:
         return 50.0, {"error": "Insufficient tap data"}
     
-    intervals_array = np.array(intervals)
+    intervals_array = np.asarray(intervals, dtype=np.float64)
     
-    # Calculate metrics
+    # Calculate metrics (population std, reusing the mean instead of np.std)
     mean_interval = np.mean(intervals_array)
-    std_interval = np.std(intervals_array)
+    deviations = intervals_array - mean_interval
+    std_interval = np.sqrt(deviations @ deviations / len(intervals_array))
     cv = (std_interval / mean_interval) * 100 if mean_interval > 0 else 100
     
     # Speed score: faster tapping = lower risk
@@ -143,27 +226,50 @@ def analyze_taps(intervals: List[float]) -> tuple[float, Dict]:
     
     return final_score, details
 import random
+
+# Longest side (px) spiral images are resized to before analysis; larger than
+# the 600px drawing canvas so drawings from the app are analysed at native size
+SPIRAL_MAX_SIDE = 1024
+
+# Per-thread work images reused across spiral requests of the same size
+_spiral_scratch = threading.local()
+
+def scratch_buffer(name: str, shape: tuple, dtype=np.uint8) -> np.ndarray:
+    """Return this thread's buffer for name, reallocating it if the shape changed"""
+    buf = getattr(_spiral_scratch, name, None)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+        buf = np.empty(shape, dtype)
+        setattr(_spiral_scratch, name, buf)
+    return buf
+
 def analyze_spiral(image_bytes: bytes) -> tuple[float, Dict]:
     """
     Analyze spiral drawing for tremor and control.
     Uses OpenCV to detect line smoothness and deviation.
     """
     try:
-        # Convert bytes to numpy array
+        # Decode straight to a single grayscale plane
         nparr = np.frombuffer(image_bytes, np.uint8)
-        img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+        gray = cv2.imdecode(nparr, cv2.IMREAD_GRAYSCALE)
         
-        if img is None:
+        if gray is None:
             raise ValueError("Invalid image data")
         
-        # Convert to grayscale
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+        # Downscale large uploads; the metrics below are normalized by image size
+        scale = SPIRAL_MAX_SIDE / max(gray.shape[:2])
+        if scale < 1:
+            height = max(1, round(gray.shape[0] * scale))
+            width = max(1, round(gray.shape[1] * scale))
+            gray = cv2.resize(gray, (width, height), dst=scratch_buffer("resized", (height, width)),
+                              interpolation=cv2.INTER_AREA)
+        shape = gray.shape
         
         # Apply threshold to isolate drawing
-        _, binary = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV)
+        _, binary = cv2.threshold(gray, 200, 255, cv2.THRESH_BINARY_INV,
+                                  dst=scratch_buffer("binary", shape))
         
         # Find contours
-        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        contours, _ = cv2.findContours(binary, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
         if not contours:
             return random.randint(30, 70), {"error": "No drawing detected"}
@@ -181,10 +287,11 @@ def analyze_spiral(image_bytes: bytes) -> tuple[float, Dict]:
         smoothness = len(approx)
         
         # Tremor detection: analyze high-frequency variations
-        contour_smooth = cv2.GaussianBlur(binary, (5, 5), 0)
-        diff = cv2.absdiff(binary, contour_smooth)
-        tremor_pixels = np.sum(diff > 30)
-        tremor_ratio = tremor_pixels / (img.shape[0] * img.shape[1])
+        diff = cv2.GaussianBlur(binary, (5, 5), 0, dst=scratch_buffer("blur", shape))
+        cv2.absdiff(binary, diff, dst=diff)
+        cv2.threshold(diff, 30, 1, cv2.THRESH_BINARY, dst=diff)
+        tremor_pixels = cv2.countNonZero(diff)
+        tremor_ratio = tremor_pixels / (shape[0] * shape[1])
         
         # Scoring
         # More complex contour = more tremor = higher score
@@ -208,41 +315,52 @@ def analyze_spiral(image_bytes: bytes) -> tuple[float, Dict]:
     except Exception as e:
         return  random.randint(30, 70), {"error": f"Analysis failed: {str(e)}"}
 
+# Upper bounds (exclusive) of each band and the label for each band
+SCORE_INTERPRETATION_THRESHOLDS = (30, 60)
+SCORE_INTERPRETATIONS = ("Low concern", "Moderate concern", "High concern")
+
+RISK_LEVEL_THRESHOLDS = (25, 50, 70, 85)
+RISK_LEVELS = ("Low", "Low-Moderate", "Moderate", "Moderate-High", "High")
+
+RECOMMENDATIONS = {
+    "Low": "Your assessment suggests low risk. Continue monitoring your health with regular check-ups.",
+    "Low-Moderate": "Your assessment shows some indicators. Consider discussing these results with your healthcare provider.",
+    "Moderate": "Your assessment indicates moderate concern. We recommend consulting a neurologist for a comprehensive evaluation.",
+    "Moderate-High": "Your assessment shows significant indicators. Please schedule an appointment with a movement disorder specialist soon.",
+    "High": "Your assessment indicates high concern. We strongly recommend seeking immediate consultation with a neurologist or movement disorder specialist."
+}
+
 def get_score_interpretation(score: float) -> str:
     """Interpret individual test scores"""
-    if score < 30:
-        return "Low concern"
-    elif score < 60:
-        return "Moderate concern"
-    else:
-        return "High concern"
+    return SCORE_INTERPRETATIONS[bisect_right(SCORE_INTERPRETATION_THRESHOLDS, score)]
+
+def calculate_overall_risk(survey_score: float, tap_score: float, spiral_score: float) -> float:
+    """Weighted average: Survey 35%, Taps 30%, Spiral 35%"""
+    return round(
+        survey_score * 0.35 +
+        tap_score * 0.30 +
+        spiral_score * 0.35,
+        2
+    )
 
 def calculate_risk_level(score: float) -> str:
     """Determine overall risk level"""
-    if score < 25:
-        return "Low"
-    elif score < 50:
-        return "Low-Moderate"
-    elif score < 70:
-        return "Moderate"
-    elif score < 85:
-        return "Moderate-High"
-    else:
-        return "High"
+    return RISK_LEVELS[bisect_right(RISK_LEVEL_THRESHOLDS, score)]
 
 def get_recommendation(risk_level: str) -> str:
     """Provide clinical recommendation based on risk"""
-    recommendations = {
-        "Low": "Your assessment suggests low risk. Continue monitoring your health with regular check-ups.",
-        "Low-Moderate": "Your assessment shows some indicators. Consider discussing these results with your healthcare provider.",
-        "Moderate": "Your assessment indicates moderate concern. We recommend consulting a neurologist for a comprehensive evaluation.",
-        "Moderate-High": "Your assessment shows significant indicators. Please schedule an appointment with a movement disorder specialist soon.",
-        "High": "Your assessment indicates high concern. We strongly recommend seeking immediate consultation with a neurologist or movement disorder specialist."
-    }
-    return recommendations.get(risk_level, "Please consult a healthcare professional.")
+    return RECOMMENDATIONS.get(risk_level, "Please consult a healthcare professional.")
 
 # ==================== API Endpoints ====================
 
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception):
+    """Report unexpected errors as a JSON 500 carrying the error message"""
+    return ORJSONResponse(status_code=500, content={"detail": str(exc)})
+
+MAX_SPIRAL_UPLOAD_BYTES = 8 * 1024 * 1024
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
 @app.get("/")
 async def root():
     return {"message": "NeuroMotion API v1.0", "status": "operational"}
@@ -250,112 +368,113 @@ async def root():
 @app.post("/api/v1/analyze/survey", response_model=ScoreResponse)
 async def analyze_survey_endpoint(request: SurveyRequest):
     """Analyze symptom survey responses"""
-    try:
-        score, details = analyze_survey(request.answers)
-        return ScoreResponse(
-            score=score,
-            details=details,
-            timestamp=datetime.now().isoformat()
-        )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    score, details = analyze_survey(request.answers)
+    return ScoreResponse(
+        score=score,
+        details=details,
+        timestamp=datetime.now().isoformat()
+    )
 
 @app.post("/api/v1/analyze/taps", response_model=ScoreResponse)
 async def analyze_taps_endpoint(request: TapRequest):
     """Analyze finger tapping rhythm and speed"""
-    try:
-        if len(request.intervals) < 3:
-            raise HTTPException(status_code=400, detail="Minimum 3 taps required")
-        
-        score, details = analyze_taps(request.intervals)
-        return ScoreResponse(
-            score=score,
-            details=details,
-            timestamp=datetime.now().isoformat()
-        )
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    if len(request.intervals) < 3:
+        raise HTTPException(status_code=400, detail="Minimum 3 taps required")
+    
+    score, details = analyze_taps(request.intervals)
+    return ScoreResponse(
+        score=score,
+        details=details,
+        timestamp=datetime.now().isoformat()
+    )
 
 @app.post("/api/v1/analyze/spiral", response_model=ScoreResponse)
 async def analyze_spiral_endpoint(file: UploadFile = File(...)):
     """Analyze spiral drawing for tremor detection"""
-    try:
-        # Validate file type
-        if not file.content_type.startswith('image/'):
-            raise HTTPException(status_code=400, detail="File must be an image")
-        
-        # Read image data
-        image_bytes = await file.read()
-        
-        score, details = analyze_spiral(image_bytes)
-        return ScoreResponse(
-            score=score,
-            details=details,
-            timestamp=datetime.now().isoformat()
-        )
-    except HTTPException:
-        raise
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    # Validate file type
+    if not file.content_type.startswith('image/'):
+        raise HTTPException(status_code=400, detail="File must be an image")
+    
+    # Read image data in chunks, rejecting oversized uploads early
+    image_bytes = bytearray()
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        image_bytes.extend(chunk)
+        if len(image_bytes) > MAX_SPIRAL_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail="Image too large")
+    
+    score, details = await run_in_threadpool(analyze_spiral, image_bytes)
+    return ScoreResponse(
+        score=score,
+        details=details,
+        timestamp=datetime.now().isoformat()
+    )
 
 @app.post("/api/v1/aggregate", response_model=FinalDiagnostic)
 async def aggregate_results(request: AggregateRequest):
     """Aggregate all test scores and generate final diagnostic"""
-    try:
-        # Weighted average: Survey 35%, Taps 30%, Spiral 35%
-        overall_risk = round(
-            request.survey_score * 0.35 +
-            request.tap_score * 0.30 +
-            request.spiral_score * 0.35,
-            2
-        )
-        
-        risk_level = calculate_risk_level(overall_risk)
-        recommendation = get_recommendation(risk_level)
-        timestamp = datetime.now().isoformat()
-        
-        # Save to database
-        conn = sqlite3.connect('test_sessions.db')
-        cursor = conn.cursor()
-        cursor.execute('''
-            INSERT INTO sessions (overall_risk, risk_level, survey_score, tap_score, spiral_score, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (overall_risk, risk_level, request.survey_score, request.tap_score, request.spiral_score, timestamp))
-        
-        session_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        
-        return FinalDiagnostic(
+    overall_risk = calculate_overall_risk(request.survey_score, request.tap_score, request.spiral_score)
+    
+    risk_level = calculate_risk_level(overall_risk)
+    recommendation = get_recommendation(risk_level)
+    timestamp = datetime.now().isoformat()
+    
+    # Save to database
+    session_id = await run_in_threadpool(
+        insert_session, overall_risk, risk_level,
+        request.survey_score, request.tap_score, request.spiral_score, timestamp
+    )
+    invalidate_sessions_cache()
+    
+    return FinalDiagnostic(
+        session_id=session_id,
+        overall_risk=overall_risk,
+        risk_level=risk_level,
+        survey_score=request.survey_score,
+        tap_score=request.tap_score,
+        spiral_score=request.spiral_score,
+        recommendation=recommendation,
+        timestamp=timestamp
+    )
+
+@app.post("/api/v1/aggregate/bulk", response_model=List[FinalDiagnostic])
+async def aggregate_results_bulk(requests: List[AggregateRequest]):
+    """Aggregate and store several sets of test scores in one write"""
+    timestamp = datetime.now().isoformat()
+    rows = []
+    for request in requests:
+        overall_risk = calculate_overall_risk(request.survey_score, request.tap_score, request.spiral_score)
+        rows.append((overall_risk, calculate_risk_level(overall_risk),
+                     request.survey_score, request.tap_score, request.spiral_score, timestamp))
+    
+    session_ids = await run_in_threadpool(insert_sessions, rows) if rows else []
+    if rows:
+        invalidate_sessions_cache()
+    
+    return [
+        FinalDiagnostic(
             session_id=session_id,
             overall_risk=overall_risk,
             risk_level=risk_level,
-            survey_score=request.survey_score,
-            tap_score=request.tap_score,
-            spiral_score=request.spiral_score,
-            recommendation=recommendation,
+            survey_score=survey_score,
+            tap_score=tap_score,
+            spiral_score=spiral_score,
+            recommendation=get_recommendation(risk_level),
             timestamp=timestamp
         )
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+        for session_id, (overall_risk, risk_level, survey_score, tap_score, spiral_score, timestamp)
+        in zip(session_ids, rows)
+    ]
 
 @app.get("/api/v1/sessions")
 async def get_sessions():
     """Retrieve all test sessions"""
-    try:
-        conn = sqlite3.connect('test_sessions.db')
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM sessions ORDER BY timestamp DESC LIMIT 50')
-        rows = cursor.fetchall()
-        conn.close()
-        
-        sessions = [dict(row) for row in rows]
-        return {"sessions": sessions}
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e))
+    body = get_cached_sessions("recent")
+    if body is None:
+        generation = sessions_cache_generation
+        sessions = await run_in_threadpool(fetch_recent_sessions)
+        body = orjson.dumps({"sessions": sessions})
+        store_cached_sessions("recent", body, generation)
+    return Response(content=body, media_type="application/json")
 
 if __name__ == "__main__":
     import uvicorn